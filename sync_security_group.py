@@ -3,16 +3,17 @@
 import os
 import sys
 import subprocess
+import argparse
+import importlib.util
+import ipaddress
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
-# Try to import boto3, if fails, try to use venv
-try:
-    import boto3
-    import requests
-    import yaml
-    from botocore.exceptions import ClientError, NoCredentialsError, PartialCredentialsError
-except ImportError:
+# Heavy dependencies are imported lazily where they are used; only check that
+# they are installed here, and if not, try to use venv
+if any(importlib.util.find_spec(module) is None for module in ('boto3', 'requests', 'yaml')):
     # Check if venv exists and we are not already running from it
     venv_python = os.path.join(os.path.dirname(os.path.abspath(__file__)), "venv", "bin", "python3")
     if os.path.exists(venv_python) and sys.executable != venv_python:
@@ -25,44 +26,162 @@ except ImportError:
 # Configuration
 YAML_FILE = 'security-group.yaml'
 CLOUDFLARE_IPV4_URL = 'https://www.cloudflare.com/ips-v4'
+CLOUDFLARE_CACHE_FILE = '.cf_ips.cache.json'
+STATE_FILE = '.sg_sync_state.json'
 SSH_PORT = 22
 HTTP_PORT = 80
+HTTP_TIMEOUT = 10
+# AWS accepts at most 1000 rules in a single authorize/revoke request
+MAX_RULES_PER_CALL = 1000
+# Adaptive mode adds client-side rate limiting on top of jittered exponential backoff
+EC2_CONFIG_OPTIONS = {
+    'retries': {'max_attempts': 10, 'mode': 'adaptive'},
+    'connect_timeout': 5,
+    'read_timeout': 30,
+}
+THROTTLE_ERROR_CODES = ('Throttling', 'RequestLimitExceeded')
+THROTTLE_RETRIES = 3
+
+def create_http_session():
+    """Create a shared HTTP session with keep-alive and retry/backoff."""
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
 
-def get_current_ip():
+    session = requests.Session()
+    retry = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+    adapter = HTTPAdapter(max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def get_current_ip(http=None):
     """Get current public IP address."""
     try:
-        response = requests.get('https://checkip.amazonaws.com')
+        http = http or create_http_session()
+        response = http.get('https://checkip.amazonaws.com', timeout=HTTP_TIMEOUT)
         response.raise_for_status()
-        return f"{response.text.strip()}/32"
+        ip = response.text.strip()
+        try:
+            ipaddress.ip_address(ip)
+        except ValueError:
+            raise ValueError(f"unexpected response from checkip: {ip[:80]!r}")
+        return f"{ip}/32"
     except Exception as e:
         print(f"Error getting public IP: {e}")
         sys.exit(1)
 
-def get_cloudflare_ips():
-    """Get Cloudflare IPv4 ranges."""
+def load_cloudflare_cache():
+    """Load the cached Cloudflare response, or an empty dict if unavailable."""
+    try:
+        with open(CLOUDFLARE_CACHE_FILE, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_cloudflare_cache(response, ips):
+    """Cache the parsed Cloudflare ranges with the response validators."""
+    cache = {
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'ips': ips,
+    }
+    try:
+        with open(CLOUDFLARE_CACHE_FILE, 'w') as f:
+            json.dump(cache, f)
+    except OSError as e:
+        print(f"Warning: could not write {CLOUDFLARE_CACHE_FILE}: {e}")
+
+def validate_cidrs(cidrs):
+    """Return cidrs unchanged, raising ValueError if any entry is not a valid CIDR."""
+    for cidr in cidrs:
+        try:
+            ipaddress.ip_network(cidr, strict=False)
+        except ValueError:
+            raise ValueError(f"invalid CIDR {cidr[:80]!r}")
+    return cidrs
+
+def get_cloudflare_ips(http=None):
+    """Get Cloudflare IPv4 ranges, revalidating a local cache with a conditional GET."""
     try:
-        response = requests.get(CLOUDFLARE_IPV4_URL)
+        http = http or create_http_session()
+        cache = load_cloudflare_cache()
+        headers = {}
+        if cache.get('ips') is not None:
+            if cache.get('etag'):
+                headers['If-None-Match'] = cache['etag']
+            if cache.get('last_modified'):
+                headers['If-Modified-Since'] = cache['last_modified']
+
+        response = http.get(CLOUDFLARE_IPV4_URL, headers=headers, timeout=HTTP_TIMEOUT, stream=True)
+        if response.status_code == 304 and headers:
+            response.close()
+            return validate_cidrs(cache['ips'])
+
         response.raise_for_status()
-        return [ip.strip() for ip in response.text.splitlines() if ip.strip()]
+        if response.encoding is None:
+            response.encoding = 'utf-8'
+        # Parse line by line as the body streams in rather than materializing
+        # the full text and splitting it
+        ips = []
+        for line in response.iter_lines(decode_unicode=True):
+            ip = line.strip()
+            if ip:
+                ips.append(ip)
+        validate_cidrs(ips)
+        save_cloudflare_cache(response, ips)
+        return ips
     except Exception as e:
         print(f"Error getting Cloudflare IPs: {e}")
         sys.exit(1)
 
+def cidr_key(cidr):
+    """Pack a CIDR into a single int (network address << 8 | prefix length).
+
+    Equal networks map to equal keys regardless of textual form, and set
+    operations hash plain ints instead of strings.
+    """
+    network = ipaddress.ip_network(cidr.strip(), strict=False)
+    return (int(network.network_address) << 8) | network.prefixlen
+
+def normalize_cidrs(cidrs):
+    """Canonicalize CIDRs and merge overlapping/adjacent ranges into a sorted list."""
+    networks = [ipaddress.ip_network(cidr.strip(), strict=False) for cidr in cidrs]
+    return sorted({str(network) for network in ipaddress.collapse_addresses(networks)})
+
 def load_yaml_config():
     """Load security group configuration from YAML."""
     if not os.path.exists(YAML_FILE):
         print(f"Error: {YAML_FILE} not found.")
         sys.exit(1)
+    import yaml
+    # Prefer the libyaml-backed C loader, falling back to pure Python
+    try:
+        from yaml import CSafeLoader as YamlLoader
+    except ImportError:
+        from yaml import SafeLoader as YamlLoader
     with open(YAML_FILE, 'r') as f:
-        return yaml.safe_load(f) or {}
+        return yaml.load(f, Loader=YamlLoader) or {}
 
 def save_yaml_config(config):
     """Save security group configuration to YAML."""
+    import yaml
+    # Prefer the libyaml-backed C dumper, falling back to pure Python
+    try:
+        from yaml import CSafeDumper as YamlDumper
+    except ImportError:
+        from yaml import SafeDumper as YamlDumper
     with open(YAML_FILE, 'w') as f:
-        yaml.dump(config, f, default_flow_style=False, sort_keys=False)
+        yaml.dump(config, f, Dumper=YamlDumper, default_flow_style=False, sort_keys=False)
 
 def get_security_group_id(ec2):
-    """Dynamically find the security group for the running instance or default."""
+    """Dynamically find the target security group.
+
+    Returns (sg_id, ip_permissions) taken from the same describe response, so the
+    caller does not need to describe the group again.
+    """
+    from botocore.exceptions import NoCredentialsError, PartialCredentialsError
+
     # In a real scenario running on EC2, we could get instance metadata.
     # For this task running locally, we'll search for a security group named 'security-group'
     # or one that allows SSH from 0.0.0.0/0 to identify the target.
@@ -80,7 +199,8 @@ def get_security_group_id(ec2):
             Filters=[{'Name': 'group-name', 'Values': ['security-group']}]
         )
         if response['SecurityGroups']:
-            return response['SecurityGroups'][0]['GroupId']
+            sg = response['SecurityGroups'][0]
+            return sg['GroupId'], sg['IpPermissions']
         
         # If not found, try to find the one attached to the instance with public IP 52.215.116.12
         # But we might not have permissions to list instances or the IP might change.
@@ -99,7 +219,7 @@ def get_security_group_id(ec2):
              # If multiple, pick the first one but warn
             sg = response['SecurityGroups'][0]
             print(f"Found security group {sg['GroupId']} allowing SSH from 0.0.0.0/0")
-            return sg['GroupId']
+            return sg['GroupId'], sg['IpPermissions']
 
         print("Error: Could not dynamically determine target Security Group.")
         sys.exit(1)
@@ -111,113 +231,181 @@ def get_security_group_id(ec2):
         print(f"Error finding security group: {e}")
         sys.exit(1)
 
-def update_security_group(ec2, sg_id, allowed_cidrs):
-    """Update security group ingress rules."""
+def describe_known_security_group(ec2, sg_id):
+    """Fetch ingress permissions for a previously resolved security group.
+
+    Uses describe_security_group_rules, which returns only the group's rules
+    rather than the whole group object, and keeps just the SSH/HTTP ingress
+    rules in IpPermissions form. Returns None if the group has no rules left
+    (including when it no longer exists), so the caller can rediscover it.
+    """
+    from botocore.exceptions import ClientError, NoCredentialsError, PartialCredentialsError
+
     try:
-        # Get current rules
-        response = ec2.describe_security_groups(GroupIds=[sg_id])
-        current_permissions = response['SecurityGroups'][0]['IpPermissions']
-        
+        rules = []
+        kwargs = {'Filters': [{'Name': 'group-id', 'Values': [sg_id]}], 'MaxResults': 1000}
+        while True:
+            response = call_with_backoff(ec2.describe_security_group_rules, **kwargs)
+            rules.extend(response['SecurityGroupRules'])
+            if not response.get('NextToken'):
+                break
+            kwargs['NextToken'] = response['NextToken']
+    except ClientError as e:
+        print(f"Error describing security group: {e}")
+        sys.exit(1)
+    except (NoCredentialsError, PartialCredentialsError):
+        print("\n❌ AWS Credentials not found.")
+        print("Please run 'aws configure' to set up your Access Key and Secret Key.")
+        sys.exit(1)
+    except Exception as e:
+        print(f"Error describing security group: {e}")
+        sys.exit(1)
+
+    if not rules:
+        print(f"No rules returned for cached security group {sg_id}, rediscovering...")
+        return None
+
+    cidrs_by_port = {SSH_PORT: [], HTTP_PORT: []}
+    for rule in rules:
+        if (not rule['IsEgress'] and rule.get('IpProtocol') == 'tcp'
+                and rule.get('FromPort') == rule.get('ToPort')
+                and rule.get('FromPort') in cidrs_by_port and rule.get('CidrIpv4')):
+            cidrs_by_port[rule['FromPort']].append(rule['CidrIpv4'])
+    return [build_permission(port, cidrs) for port, cidrs in cidrs_by_port.items() if cidrs]
+
+def build_permission(port, cidrs):
+    """Build a single tcp IpPermissions entry for the given port and CIDRs."""
+    return {
+        'IpProtocol': 'tcp',
+        'FromPort': port,
+        'ToPort': port,
+        'IpRanges': [{'CidrIp': cidr} for cidr in cidrs]
+    }
+
+def chunk_cidrs(cidrs):
+    """Split CIDRs into batches that stay within the per-call rule limit."""
+    cidrs = sorted(cidrs)
+    return [cidrs[i:i + MAX_RULES_PER_CALL] for i in range(0, len(cidrs), MAX_RULES_PER_CALL)]
+
+def call_with_backoff(call, **kwargs):
+    """Invoke an EC2 API call, sleeping and retrying if it is still throttled."""
+    from botocore.exceptions import ClientError
+
+    for attempt in range(THROTTLE_RETRIES + 1):
+        try:
+            return call(**kwargs)
+        except ClientError as e:
+            if e.response['Error']['Code'] not in THROTTLE_ERROR_CODES or attempt == THROTTLE_RETRIES:
+                raise
+            delay = 2 ** attempt
+            print(f"EC2 API throttled, retrying in {delay}s...")
+            time.sleep(delay)
+
+def update_security_group(ec2, sg_id, allowed_cidrs, current_permissions):
+    """Update security group ingress rules. Returns True if any rule was changed."""
+    try:
+        # Only tcp rules count, matching how describe_known_security_group
+        # filters the rules it returns
+        tcp_permissions = [perm for perm in current_permissions if perm.get('IpProtocol') == 'tcp']
+
         # 1. Ensure SSH is open to 0.0.0.0/0
         ssh_open = False
-        for perm in current_permissions:
+        for perm in tcp_permissions:
             if perm.get('FromPort') == SSH_PORT and perm.get('ToPort') == SSH_PORT:
                 for ip_range in perm.get('IpRanges', []):
                     if ip_range.get('CidrIp') == '0.0.0.0/0':
                         ssh_open = True
                         break
         
-        if not ssh_open:
-            print("Adding SSH access for 0.0.0.0/0...")
-            ec2.authorize_security_group_ingress(
-                GroupId=sg_id,
-                IpPermissions=[{
-                    'IpProtocol': 'tcp',
-                    'FromPort': SSH_PORT,
-                    'ToPort': SSH_PORT,
-                    'IpRanges': [{'CidrIp': '0.0.0.0/0'}]
-                }]
-            )
-
         # 2. Sync HTTP rules
         # Get current HTTP CIDRs
-        current_http_cidrs = set()
-        for perm in current_permissions:
+        # keyed by packed network so textual differences don't cause churn;
+        # the value is kept as AWS reported it for use in revoke calls
+        current_http_cidrs = {}
+        for perm in tcp_permissions:
             if perm.get('FromPort') == HTTP_PORT and perm.get('ToPort') == HTTP_PORT:
                 for ip_range in perm.get('IpRanges', []):
-                    current_http_cidrs.add(ip_range['CidrIp'])
+                    current_http_cidrs[cidr_key(ip_range['CidrIp'])] = ip_range['CidrIp']
         
-        target_http_cidrs = set(allowed_cidrs)
+        target_http_cidrs = {cidr_key(cidr): cidr for cidr in allowed_cidrs}
         
-        # Calculate diff
-        to_revoke = current_http_cidrs - target_http_cidrs
-        to_authorize = target_http_cidrs - current_http_cidrs
+        # Calculate diff on the int keys, then map back to CIDR strings
+        to_revoke = {current_http_cidrs[key]
+                     for key in current_http_cidrs.keys() - target_http_cidrs.keys()}
+        to_authorize = {target_http_cidrs[key]
+                        for key in target_http_cidrs.keys() - current_http_cidrs.keys()}
         
+        # Fold the SSH rule and the new HTTP rules into one authorize request
+        # so a typical sync costs at most one authorize and one revoke call.
+        calls = []
         if to_revoke:
             print(f"Revoking {len(to_revoke)} stale HTTP rules...")
-            ec2.revoke_security_group_ingress(
-                GroupId=sg_id,
-                IpPermissions=[{
-                    'IpProtocol': 'tcp',
-                    'FromPort': HTTP_PORT,
-                    'ToPort': HTTP_PORT,
-                    'IpRanges': [{'CidrIp': cidr} for cidr in to_revoke]
-                }]
-            )
-            
+            for batch in chunk_cidrs(to_revoke):
+                calls.append((ec2.revoke_security_group_ingress,
+                              [build_permission(HTTP_PORT, batch)]))
+
+        authorize_batches = [[build_permission(HTTP_PORT, batch)]
+                             for batch in chunk_cidrs(to_authorize)]
         if to_authorize:
             print(f"Authorizing {len(to_authorize)} new HTTP rules...")
-            # AWS has a limit on rules per call, but usually 60 is fine.
-            # Cloudflare has ~15 ranges, plus home IP. Should be safe.
-            ec2.authorize_security_group_ingress(
-                GroupId=sg_id,
-                IpPermissions=[{
-                    'IpProtocol': 'tcp',
-                    'FromPort': HTTP_PORT,
-                    'ToPort': HTTP_PORT,
-                    'IpRanges': [{'CidrIp': cidr} for cidr in to_authorize]
-                }]
-            )
+        if not ssh_open:
+            print("Adding SSH access for 0.0.0.0/0...")
+            ssh_permission = build_permission(SSH_PORT, ['0.0.0.0/0'])
+            # Only fold it in if that keeps the request within the per-call limit
+            if authorize_batches and len(authorize_batches[0][0]['IpRanges']) < MAX_RULES_PER_CALL:
+                authorize_batches[0].append(ssh_permission)
+            else:
+                authorize_batches.append([ssh_permission])
+        for permissions in authorize_batches:
+            calls.append((ec2.authorize_security_group_ingress, permissions))
+
+        # Revoke and authorize sets are disjoint, so the requests are independent
+        # and can be in flight at the same time (boto3 clients are thread-safe).
+        if len(calls) > 1:
+            with ThreadPoolExecutor(max_workers=len(calls)) as executor:
+                futures = [executor.submit(call_with_backoff, call,
+                                           GroupId=sg_id, IpPermissions=permissions)
+                           for call, permissions in calls]
+                for future in futures:
+                    future.result()
+        else:
+            for call, permissions in calls:
+                call_with_backoff(call, GroupId=sg_id, IpPermissions=permissions)
             
-        return True
+        return bool(calls)
     except Exception as e:
         print(f"Error updating security group: {e}")
         sys.exit(1)
 
+# Runs the whole commit flow in one shell so git is spawned from a single fork;
+# $1 is the YAML file and $2 the commit message.
+GIT_SYNC_SCRIPT = (
+    'if git diff HEAD --quiet -- "$1"; then '
+    'echo "No changes to commit."; '
+    'else '
+    'echo "Committing and pushing changes..." && '
+    'git pull && git add -- "$1" && git commit -m "$2" && git push; '
+    'fi'
+)
+
 def git_commit_and_push():
     """Commit and push changes to Git."""
     try:
-        # Check if there are changes
-        status = subprocess.check_output(['git', 'status', '--porcelain']).decode()
-        if not status:
-            print("No changes to commit.")
-            return
-
-        print("Committing and pushing changes...")
-        subprocess.check_call(['git', 'pull'])
-        subprocess.check_call(['git', 'add', YAML_FILE])
-        subprocess.check_call(['git', 'commit', '-m', 'Update security group rules [skip ci]'])
-        subprocess.check_call(['git', 'push'])
+        subprocess.check_call(['sh', '-c', GIT_SYNC_SCRIPT, 'git-sync', YAML_FILE,
+                               'Update security group rules [skip ci]'])
     except subprocess.CalledProcessError as e:
         print(f"Git operation failed: {e}")
         # Don't exit, just warn
 
-def main():
-    print("============================================================")
-    print("EC2 Security Group Sync Script")
-    print("============================================================")
-    
-    # 1. Get IPs
-    home_ip = get_current_ip()
-    print(f"✓ Home IP: {home_ip}")
-    
-    cf_ips = get_cloudflare_ips()
-    print(f"✓ Fetched {len(cf_ips)} Cloudflare IP ranges")
-    
-    # 2. Prepare target rules
-    target_http_cidrs = sorted(list(set([home_ip] + cf_ips)))
-    
-    # 3. AWS Setup
+def create_ec2_client():
+    """Create an EC2 client for the configured region. Returns (region, ec2)."""
+    # This runs from a PC/laptop, so skip the instance metadata (IMDS) probes in
+    # the credential/region chain, which only time out off EC2. Set
+    # AWS_EC2_METADATA_DISABLED=false to re-enable them when running on EC2.
+    os.environ.setdefault('AWS_EC2_METADATA_DISABLED', 'true')
+    import boto3
+    from botocore.config import Config
+
     # Boto3 will automatically look for credentials in env vars or ~/.aws/credentials
     # It also handles region detection if configured.
     session = boto3.Session()
@@ -226,30 +414,98 @@ def main():
         # Fallback if not set in config
         region = 'eu-west-1' # Defaulting based on typical usage, or could query metadata if on EC2
         session = boto3.Session(region_name=region)
-        
-    print(f"✓ Detected AWS Region: {region}")
-    ec2 = session.client('ec2')
+    return region, session.client('ec2', config=Config(**EC2_CONFIG_OPTIONS))
+
+def load_state():
+    """Load the state saved by the last successful sync, or an empty dict."""
+    try:
+        with open(STATE_FILE, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_state(state):
+    """Persist the resolved region and security group for the next run."""
+    try:
+        with open(STATE_FILE, 'w') as f:
+            json.dump(state, f)
+    except OSError as e:
+        print(f"Warning: could not write {STATE_FILE}: {e}")
+
+def discover_security_group(force_discover=False):
+    """Set up the EC2 client and locate the target security group.
+
+    The group resolved on the last run is reused when the region still matches,
+    skipping the search. Returns (region, ec2, sg_id, ip_permissions).
+    """
+    region, ec2 = create_ec2_client()
+    state = {} if force_discover else load_state()
+    if state.get('sg_id') and state.get('region') == region:
+        ip_permissions = describe_known_security_group(ec2, state['sg_id'])
+        if ip_permissions is not None:
+            return region, ec2, state['sg_id'], ip_permissions
+    sg_id, ip_permissions = get_security_group_id(ec2)
+    return region, ec2, sg_id, ip_permissions
+
+def parse_args():
+    """Parse command-line options."""
+    parser = argparse.ArgumentParser(description="Sync EC2 security group rules with Cloudflare IP ranges and your home IP.")
+    parser.add_argument('--force-discover', action='store_true',
+                        help=f"ignore {STATE_FILE} and search for the security group again")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    print("============================================================")
+    print("EC2 Security Group Sync Script")
+    print("============================================================")
     
-    # 4. Find Security Group
-    sg_id = get_security_group_id(ec2)
+    # 1. IP lookups, AWS discovery and the YAML load are independent of each
+    # other, so run them concurrently; only the rule sync needs all of them.
+    http = create_http_session()
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        home_ip_future = executor.submit(get_current_ip, http)
+        cf_ips_future = executor.submit(get_cloudflare_ips, http)
+        aws_future = executor.submit(discover_security_group, args.force_discover)
+        config_future = executor.submit(load_yaml_config)
+        home_ip = home_ip_future.result()
+        cf_ips = cf_ips_future.result()
+        region, ec2, sg_id, current_permissions = aws_future.result()
+        config = config_future.result()
+    print(f"✓ Home IP: {home_ip}")
+    print(f"✓ Fetched {len(cf_ips)} Cloudflare IP ranges")
+    print(f"✓ Detected AWS Region: {region}")
     print(f"✓ Found Security Group: {sg_id}")
     
-    # 5. Sync Rules
-    update_security_group(ec2, sg_id, target_http_cidrs)
-    print("✓ Security group synced")
+    # 2. Prepare target rules
+    target_http_cidrs = normalize_cidrs([home_ip] + cf_ips)
     
-    # 6. Update YAML
-    config = load_yaml_config()
-    config['rules']['http'] = target_http_cidrs
-    # Ensure SSH is there
-    if 'ssh' not in config['rules']:
-        config['rules']['ssh'] = ['0.0.0.0/0']
+    # 3. Sync Rules
+    sg_changed = update_security_group(ec2, sg_id, target_http_cidrs, current_permissions)
+    if sg_changed:
+        print("✓ Security group synced")
+    else:
+        print("✓ Security group already in sync")
+    save_state({'region': region, 'sg_id': sg_id})
     
-    save_yaml_config(config)
-    print("✓ Updated security-group.yaml")
+    # 4. Update YAML (only rewritten when the desired state actually differs)
+    rules = config.setdefault('rules', {})
+    yaml_changed = rules.get('http', []) != target_http_cidrs or 'ssh' not in rules
+    if yaml_changed:
+        rules['http'] = target_http_cidrs
+        # Ensure SSH is there
+        if 'ssh' not in rules:
+            rules['ssh'] = ['0.0.0.0/0']
+        save_yaml_config(config)
+        print("✓ Updated security-group.yaml")
+    else:
+        print("✓ security-group.yaml already up to date")
     
-    # 7. Git Ops
-    git_commit_and_push()
+    # 5. Git Ops
+    if sg_changed or yaml_changed:
+        git_commit_and_push()
+    else:
+        print("No changes to commit.")
     print("============================================================")
     print("✓ Sync completed successfully!")
     print("  Test URL: http://2bcloud.io")